@@ -0,0 +1,27 @@
+"""Ahead-of-time build of the dispatch kernel into the dispatch_mod extension module.
+
+Run `python _dispatch_aot.py` from the repository root. The build is stamped with a
+hash of the dispatch_plants source: production_plan only uses dispatch_mod when the
+hash matches, and falls back to the numba JIT kernel otherwise, so the module must be
+rebuilt whenever dispatch_plants changes.
+"""
+import os
+
+from numba.pycc import CC
+
+from production_plan import dispatch_plants, kernel_source_hash
+
+KERNEL_SOURCE_HASH = kernel_source_hash()
+
+cc = CC('dispatch_mod')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+cc.export('dispatch_plants', 'f8[:](f8, f8[:], f8[:], i8[:])')(dispatch_plants.py_func)
+
+
+@cc.export('source_hash', 'i8()')
+def source_hash():
+    return KERNEL_SOURCE_HASH
+
+
+if __name__ == '__main__':
+    cc.compile()
@@ -1,7 +1,13 @@
 
-from flask import Flask, json, request, jsonify
+from flask import Flask, request
+import hashlib
+import inspect
 import logging
-from math import isclose
+import os
+from math import ceil, floor, fsum, isclose
+import numpy as np
+from numba import njit
+import orjson
 
 app = Flask(__name__)
 
@@ -12,6 +18,28 @@ logging.basicConfig(filename='productionplan.log',
 
 logger = logging.getLogger(__name__)
 
+# Integer codes used to store the plant type in the plant arrays
+PLANT_TYPE_CODES = {'windturbine': 0, 'gasfired': 1, 'turbojet': 2}
+UNKNOWN_PLANT_TYPE = 3
+
+
+def cost_tables(fuels: dict, type_codes) -> tuple:
+    """Fuel price and CO2 cost per MWh produced, indexed by plant type code.
+    Raises ValueError if a price needed by one of the given type codes is missing.
+    """
+    gas_price = fuels.get('gas(euro/MWh)')
+    co2_price = fuels.get('co2(euro/ton)', 0)
+    kerosine_price = fuels.get('kerosine(euro/MWh)')
+    if gas_price is None and PLANT_TYPE_CODES['gasfired'] in type_codes:
+        raise ValueError('Missing gas price in fuels')
+    if kerosine_price is None and PLANT_TYPE_CODES['turbojet'] in type_codes:
+        raise ValueError('Missing kerosine price in fuels')
+
+    # Indexed by wind, gas, turbojet, unknown
+    fuel_price = np.array([0.0, gas_price or 0.0, kerosine_price or 0.0, np.inf])
+    co2_cost = np.array([0.0, 0.3 * co2_price, 0.0, 0.0]) #Taking CO2 pricing into account at 0.3 ton/MWh
+    return fuel_price, co2_cost
+
 
 def compute_cost(plant: dict, fuels: dict) -> float:
     """Compute marginal cost for a plant given fuels and efficiency.
@@ -21,195 +49,245 @@ def compute_cost(plant: dict, fuels: dict) -> float:
     - turbojet: uses 'kerosine(euro/MWh)' fuel value
     - windturbine: cost = 0
     """
-    ptype = plant.get('type')
-    eff = plant.get('efficiency', 1.0)
-
-    if ptype == 'windturbine':
-        return 0.0
-    elif ptype == 'gasfired':
-        gas_price = fuels.get('gas(euro/MWh)')
-        co2_price = fuels.get('co2(euro/ton)', 0)
-        if gas_price is None:
-            raise ValueError('Missing gas price in fuels')
-        return gas_price / eff + 0.3 * co2_price #Taking CO2 pricing into account at 0.3 ton/MWh
-    elif ptype == 'turbojet':
-        kerosine_price = fuels.get('kerosine(euro/MWh)')
-        if kerosine_price is None:
-            raise ValueError('Missing kerosine price in fuels')
-        return kerosine_price / eff
-    else:
-        return float('inf')
-
-
-def obtain_power(plant: dict, fuels: dict) -> tuple:
-    """Adjust pmax & pmin for wind turbines using wind% (from fuels['wind(%)']).
-    For wind turbines, pmin is treated as 0 (they are not dispatchable below 0),
-    and pmax = original_pmax * wind_percent/100.
-    """
-    if plant.get('type') != 'windturbine':
-        return plant['pmin'], plant['pmax']
-    pmax, pmin = get_windpowerplant_power(plant, fuels)
-    return pmin, pmax
+    type_code = PLANT_TYPE_CODES.get(plant.get('type'), UNKNOWN_PLANT_TYPE)
+    fuel_price, co2_cost = cost_tables(fuels, (type_code,))
+    price = fuel_price[type_code]
+    # No division for free fuel, wind stays at 0 whatever its efficiency
+    if price == 0.0:
+        return float(co2_cost[type_code])
+    return float(price / plant.get('efficiency', 1.0) + co2_cost[type_code])
 
-def get_windpowerplant_power(plant: dict, fuels: dict) -> tuple:
+
+def get_wind_factor(fuels: dict) -> float:
+    """Share of the wind turbines pmax available, from fuels['wind(%)'] clipped to [0, 100]."""
     windp = fuels.get('wind(%)')
     try:
-        factor = max(0.0, min(100.0, float(windp))) / 100.0
+        return max(0.0, min(100.0, float(windp))) / 100.0
     except Exception as e:
         raise ValueError('Invalid or missing wind(%) in fuels') from e
-    pmax = plant['pmax'] * factor
-    pmin = 0.0
-    return pmax,pmin
 
-def ensure_total_equals_load(load: float, running_plants: dict, response: list, rounded_total: float):
+def ensure_total_equals_load(load: float, power: np.ndarray, pmin: np.ndarray, pmax: np.ndarray,
+                             asc_order: np.ndarray, rounded_total: float) -> float:
     """
     Ensure total rounding still equals load (within 0.1). 
-    If not, adjust the cheapest plant accordingly.
+    If not, spread the difference over the running plants in a single pass, in place on power:
+    missing production goes to the cheapest plants with spare capacity,
+    excess is cut from the most expensive plants down to their pmin.
+    Returns the updated total production.
     """
     difference = round(load - rounded_total, 1)
     if abs(difference) >= 0.1:
-        # find cheapest non-wind plant where the delta can fit within pmin/pmax
-        for plant in sorted(running_plants, key=lambda x: x['cost']):
-            for r in response:
-                if r['name'] == plant['name']:
-                    new_p = r['power'] + difference
-                    if new_p >= plant['pmin'] - 1e-9 and new_p <= plant['pmax'] + 1e-9 and new_p >= 0.0:
-                        r['power'] = round(new_p, 1)
-                        difference = 0.0
-                    break
-            if difference == 0.0:
+        for i in (asc_order if difference > 0 else asc_order[::-1]):
+            # plants that are off stay off, they could not run under their pmin
+            if power[i] <= 0.0 and pmin[i] > 0.0:
+                continue
+            # whole 0.1 MW steps only, so the plant stays within its limits
+            if difference > 0:
+                delta = min(difference, floor((pmax[i] - power[i]) * 10 + 1e-9) / 10)
+            else:
+                delta = max(difference, ceil((pmin[i] - power[i]) * 10 - 1e-9) / 10)
+            if abs(delta) < 0.05:
+                continue
+            new_p = round(power[i] + delta, 1)
+            rounded_total += new_p - power[i]
+            power[i] = new_p
+            difference = round(load - rounded_total, 1)
+            if abs(difference) < 0.1:
                 break
+    return rounded_total
+
+def round_within_limits(power: np.ndarray, pmin: np.ndarray, pmax: np.ndarray) -> np.ndarray:
+    """Round running plants to 0.1 MW without leaving [pmin, pmax]:
+    the limits themselves are rounded inward (pmin up, pmax down). Plants that are off stay at 0.
+    """
+    grid_pmin = np.ceil(pmin * 10 - 1e-9) / 10
+    grid_pmax = np.floor(pmax * 10 + 1e-9) / 10
+    return np.where(power > 0.0, np.clip(np.round(power, 1), grid_pmin, grid_pmax), 0.0)
+
+def outside_limits(power: np.ndarray, pmin: np.ndarray, pmax: np.ndarray) -> np.ndarray:
+    """Indices of the plants whose production is neither 0 nor within [pmin, pmax]."""
+    return np.flatnonzero((power != 0.0) & ((power < pmin - 1e-9) | (power > pmax + 1e-9)))
+
+def compute_costs(type_code: np.ndarray, efficiency: np.ndarray, fuels: dict) -> np.ndarray:
+    """Vectorised compute_cost: marginal cost of every plant in one pass.
+    Same rules as compute_cost, unknown plant types get an infinite cost.
+    """
+    fuel_price, co2_cost = cost_tables(fuels, type_code)
+    price = fuel_price[type_code]
+    # Free fuel costs 0 whatever the efficiency, avoids 0/0 for wind turbines with efficiency 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(price == 0.0, 0.0, price / efficiency) + co2_cost[type_code]
+
+def max_capacity(plants: list, fuels: dict) -> float:
+    """Upper bound of the production read straight from the payload, without building the plant arrays.
+    Raises ValueError for an invalid wind(%) when the payload contains wind turbines.
+    """
+    has_wind = any(plant['type'] == 'windturbine' for plant in plants)
+    wind_factor = get_wind_factor(fuels) if has_wind else 1.0
+    return fsum(plant['pmax'] * wind_factor if plant['type'] == 'windturbine' else plant['pmax']
+                for plant in plants)
+
+def process_plants(plants: list, fuels: dict) -> tuple:
+    """Process plants to adjust pmin/pmax for wind turbines and compute costs.
+    Plants are returned as parallel arrays indexed by their position in the payload:
+    (names, pmin, pmax, cost)
+    The float arrays are rows of a single contiguous buffer, so each one is contiguous too.
+    """
+    names = [plant['name'] for plant in plants]
+    type_code = np.array([PLANT_TYPE_CODES.get(plant['type'], UNKNOWN_PLANT_TYPE) for plant in plants],
+                         dtype=np.int8)
+    plant_data = np.empty((4, len(plants)), dtype=np.float64)
+    efficiency, pmin, pmax, cost = plant_data
+    efficiency[:] = [plant.get('efficiency', 1.0) for plant in plants]
+    is_wind = type_code == PLANT_TYPE_CODES['windturbine']
+    # Wind turbines are not dispatchable below 0, their pmin is not read
+    pmin[:] = [0.0 if wind else plant['pmin'] for plant, wind in zip(plants, is_wind)]
+    pmax[:] = [plant['pmax'] for plant in plants]
+
+    # pmax of wind turbines scaled by wind(%), read once for all of them
+    if is_wind.any():
+        pmax[is_wind] *= get_wind_factor(fuels)
+    cost[:] = compute_costs(type_code, efficiency, fuels)
+    return names, pmin, pmax, cost
+
+@njit(cache=True)
+def dispatch_plants(load: float, pmin: np.ndarray, pmax: np.ndarray, asc_order: np.ndarray) -> np.ndarray:
+    """Priority-list dispatch: plants are committed in merit order at pmax until their
+    cumulative pmax covers the load, and the marginal plant fills the exact remainder.
+    If the remainder is below the marginal plant pmin, it runs at pmin and the cheaper
+    plants back down by the overshoot; when they cannot, the marginal plant stays off
+    and the next plant in the merit order is tried.
+    """
+    n = len(asc_order)
+    power = np.zeros(n, dtype=np.float64)
+    if n == 0:
+        return power
+    pmin_sorted = pmin[asc_order]
+    pmax_sorted = pmax[asc_order]
+    cum_pmax = np.cumsum(pmax_sorted)
+    cum_pmin = np.cumsum(pmin_sorted)
+
+    # Plants cheaper than the marginal one run at pmax
+    k = min(np.searchsorted(cum_pmax, load), n - 1)
+    for j in range(k):
+        power[asc_order[j]] = pmax_sorted[j]
+    committed = cum_pmax[k - 1] if k > 0 else 0.0
+    committed_pmin = cum_pmin[k - 1] if k > 0 else 0.0
+
+    remaining = load - committed
+    for j in range(k, n):
+        if remaining <= 1e-9:
+            break
+        if pmax_sorted[j] <= 0.0:
+            continue
+        plant_power = max(pmin_sorted[j], min(pmax_sorted[j], remaining))
+        overshoot = plant_power - remaining
+        if overshoot > 1e-9:
+            if committed - committed_pmin < overshoot:
+                continue
+            # Back down the plants already running, most expensive first
+            for m in range(j - 1, -1, -1):
+                if overshoot <= 1e-9:
+                    break
+                i = asc_order[m]
+                if power[i] <= pmin[i]:
+                    continue
+                reduce_by = min(power[i] - pmin[i], overshoot)
+                power[i] -= reduce_by
+                overshoot -= reduce_by
+            remaining = 0.0
+        else:
+            remaining -= plant_power
+        power[asc_order[j]] = plant_power
+        committed = load - remaining
+        committed_pmin += pmin_sorted[j]
+    return power
+
+def kernel_source_hash() -> int:
+    """Hash of the dispatch_plants source, stamped into the ahead-of-time build by _dispatch_aot.py."""
+    source = inspect.getsource(dispatch_plants.py_func)
+    return int.from_bytes(hashlib.sha256(source.encode()).digest()[:7], 'big')
+
+try:
+    # Kernel compiled ahead of time by _dispatch_aot.py
+    import dispatch_mod
+except ImportError:
+    dispatch_mod = None
 
-def process_plants(running_plants: list, plants: dict, fuels: dict)-> tuple:
-    """Process plants to adjust pmin/pmax for wind turbines and compute costs."""
-    total_max = 0.0
-    total_min = 0.0
-    for plant in plants:
-        try:
-            pmin, pmax = obtain_power(plant, fuels)
-        except Exception as e:
-            logger.exception('Error adjusting wind pmax')
-            return jsonify({'error': str(e)}), 400
-
-        running_plant = {
-            'name': plant['name'],
-            'type': plant['type'],
-            'efficiency': plant.get('efficiency', 1.0),
-            'pmin': float(pmin),
-            'pmax': float(pmax),
-            'cost': compute_cost(plant, fuels)
-        }
-        running_plants.append(running_plant)
-        total_max += running_plant['pmax']
-        total_min += running_plant['pmin']
-    return total_min, total_max
+if dispatch_mod is not None and getattr(dispatch_mod, 'source_hash', lambda: None)() == kernel_source_hash():
+    dispatch_kernel = dispatch_mod.dispatch_plants
+    logger.info('Using the ahead-of-time compiled dispatch kernel')
+else:
+    if dispatch_mod is not None:
+        logger.warning('dispatch_mod does not match the current dispatch_plants, rebuild it with _dispatch_aot.py')
+    dispatch_kernel = dispatch_plants
+    # Compile the dispatch kernel at import time so the first request does not pay for it
+    dispatch_kernel(0.0, np.zeros(1), np.zeros(1), np.zeros(1, dtype=np.intp))
+    logger.info('Using the JIT compiled dispatch kernel')
 
         
+def json_response(data, status: int):
+    """Serialize data with orjson, faster than jsonify for large plant lists."""
+    return app.response_class(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY),
+                              status=status, mimetype='application/json')
+
 @app.route('/productionplan', methods=['POST'])
 def productionplan():
-    payload = getattr(app, 'payload', None)
+    payload = request.get_json(silent=True)
     try:
         load = float(payload['load'])
         plants = payload['powerplants']
         fuels = payload['fuels']
     except Exception as e:
         logger.exception('Some keys in payload could not be found.')
-        return jsonify({'error': 'wrong payload format'}), 400
-    running_plants = []
-    total_min, total_max = process_plants(running_plants, plants, fuels)
-    
-    if load < total_min or load > total_max:
-        msg = f'Requested load is loo large or too small! Load: {load}. Range: [{total_min}, {total_max}]'
-        logger.error(msg)
-        return jsonify({'error': msg}), 400
+        return json_response({'error': 'wrong payload format'}, 400)
 
-    # Initialize production to pmin
-    for plant in running_plants:
-        # plant['power'] = plant['pmin']
-        plant['power'] = 0
-        
+    try:
+        # Fail fast on loads no combination of plants can produce
+        capacity = max_capacity(plants, fuels)
+        if load < 0 or load > capacity:
+            msg = f'Requested load is out of range! Load: {load}. Maximum capacity: {capacity}'
+            logger.error(msg)
+            return json_response({'error': msg}, 400)
 
-    # Sort by ascending cost
-    running_plants = sorted(running_plants, key=lambda x: x['cost'])
-    remaining_total_load = load - sum(it['power'] for it in running_plants)
+        names, pmin, pmax, cost = process_plants(plants, fuels)
+    except KeyError as e:
+        logger.exception('Some keys in powerplants could not be found.')
+        return json_response({'error': f'wrong payload format: missing {e}'}, 400)
+    except (ValueError, TypeError) as e:
+        logger.exception('Error processing powerplants')
+        return json_response({'error': f'wrong payload format: {e}'}, 400)
+    # The upper bound was already checked against capacity
+    total_min = fsum(pmin)
+    if load < total_min:
+        msg = f'Requested load is too small! Load: {load}. Range: [{total_min}, {capacity}]'
+        logger.error(msg)
+        return json_response({'error': msg}, 400)
 
-    # We loop over plants in crescient cost order
-    for plant in running_plants:
-        if remaining_total_load <= 1e-9:
-            break
-        available = plant['pmax'] - plant['power']
-        to_add = min(available, remaining_total_load)
-        plant['power'] += to_add
-        remaining_total_load -= to_add
-
-    # If remaining > 0, try redistribution
-    # If remaining < 0 (we overshot due to pmin constraints), reduce from most expensive
-    # We'll perform iterative adjustments: reduce from expensive ones, increase cheaper ones
-    max_iter = 1000
-    iter_count = 0
-    minimum_difference = 1e-6
-    if not isclose(sum(it['power'] for it in running_plants), load, rel_tol=0, abs_tol=0.5) and iter_count < max_iter:
-        logger.warning('Algorithm did not reach exact load; final_total=%s target=%s', final_total, load)
-        
-    final_total = optional_precision_iteration(load, running_plants, max_iter, iter_count, minimum_difference)
+    # Sort by ascending cost once, every traversal reuses this order
+    asc_order = np.argsort(cost, kind='stable')
+    power = dispatch_kernel(load, pmin, pmax, asc_order)
+
+    final_total = fsum(power)
     if not isclose(final_total, load, rel_tol=0, abs_tol=0.5):
         logger.warning('Algorithm did not reach exact load; final_total=%s target=%s', final_total, load)
 
     # Round productions to one decimal like in example responses
-    response = []
-    for plant in running_plants:
-        response.append({'name': plant['name'], 'power': plant['power']})
-
-    rounded_total = sum(r['power'] for r in response)
-    ensure_total_equals_load(load, running_plants, response, rounded_total)
-
-    final_rounded_total = sum(r['power'] for r in response)
+    power = round_within_limits(power, pmin, pmax)
+    final_rounded_total = ensure_total_equals_load(load, power, pmin, pmax, asc_order, fsum(power))
     if not isclose(final_rounded_total, load, rel_tol=0, abs_tol=0.5):
         msg = f'ERROR! Unable to match load precisely after rounding: rounded_total={final_rounded_total}, target={load}'
         logger.warning(msg)
+    broken = outside_limits(power, pmin, pmax)
+    if broken.size:
+        logger.error('Production outside pmin/pmax for plants %s', [names[i] for i in broken])
 
+    response = [{'name': names[i], 'power': float(power[i])} for i in asc_order]
     logger.info('Production plan computed successfully for load %s', load)
-    return jsonify(response), 200
-
-def optional_precision_iteration(load, running_plants, max_iter, iter_count, minimum_difference):
-    while not isclose(sum(it['power'] for it in running_plants), load, rel_tol=0, abs_tol=0.5) and iter_count < max_iter:
-        total = sum(it['power'] for it in running_plants)
-        diff = total - load
-        if abs(diff) < minimum_difference:
-            break
-
-        if diff > 0:
-            # Need to reduce production by diff.
-            # Reduce from most expensive plants first (but keep >= pmin)
-            for plant in sorted(running_plants, key=lambda x: x['cost'], reverse=True):
-                if diff <= minimum_difference:
-                    break
-                reducible = plant['power'] - plant['pmin']
-                reduce_by = min(reducible, diff)
-                if reduce_by > 0:
-                    plant['power'] -= reduce_by
-                    diff -= reduce_by
-        else:
-            # Need to increase production (-diff). Add to cheapest plants with spare capacity
-            need = -diff
-            for plant in sorted(running_plants, key=lambda x: x['cost']):
-                if need <= minimum_difference:
-                    break
-                spare = plant['pmax'] - plant['power']
-                add = min(spare, need)
-                if add > 0:
-                    plant['power'] += add
-                    need -= add
-
-        iter_count += 1
-    final_total = sum(it['power'] for it in running_plants)
-    return final_total
+    return json_response(response, 200)
 
 if __name__ == '__main__':
-    data_path = 'example_payloads/payload3.json'
-    try:
-        app.payload = json.load(open(data_path, 'r'))
-    except Exception as e:
-        logger.exception('Failed to parse data file')
-        
-    app.run(host='localhost', port=8888, debug=True)
+    # Development server only, production runs behind gunicorn:
+    # gunicorn -w 4 -k gthread -b 0.0.0.0:8888 production_plan:app
+    debug = os.environ.get('PRODUCTIONPLAN_DEBUG', '0') == '1'
+    app.run(host='localhost', port=8888, debug=debug)